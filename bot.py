@@ -2,7 +2,6 @@ import sys
 import re
 
 from datetime import datetime, timezone, timedelta
-from truthcord.truthcord import TruthCord
 
 def parse_date_arg(arg: str) -> datetime:
     """
@@ -44,7 +43,12 @@ if __name__ == '__main__':
         if '=' in arg:
             key, value = arg.split('=', 1)
             args[key] = value
+    if sys.argv[1:2] == ['replay']:
+        from truthcord.replay import run_replay
+        run_replay(**args)
+        sys.exit()
     if 'pull_since' in args:
         args['pull_since'] = parse_date_arg(args['pull_since'])
+    from truthcord.truthcord import TruthCord
     bot = TruthCord(**args)
     bot.run()
\ No newline at end of file
@@ -0,0 +1,392 @@
+"""Load test TruthCord against local stand-ins for Truth Social, Discord and Azure Translator.
+
+The fakes run in a child process. The bot runs in this process, pointed at the fakes through its
+environment variables, so the memory figures only cover the bot.
+
+    python loadtest.py accounts=500 posts=200 scenario=burst latency=0.05 error_rate=0.01
+
+Arguments (key=value):
+    accounts     number of monitored accounts (default 20)
+    posts        number of posts published during the run (default 200)
+    scenario     burst: every post goes live at once; steady: posts are spread over `duration` (default burst)
+    duration     seconds over which a steady scenario publishes (default 30)
+    poll         seconds between polls (default 1)
+    timeout      give up after this many seconds (default 300)
+    settle       stop after this many idle polls once the last post is published (default 5); a poll is idle if
+                 nothing new arrived and no Truth Social request was throttled or failed
+    latency      mean added latency per fake request in seconds (default 0)
+    error_rate   fraction of fake requests answered with a server error (default 0)
+    rate_limit   Truth Social requests allowed per `rate_window` seconds, 0 for unlimited (default 0)
+    rate_window  rate limit window in seconds (default 300)
+    translate    1 to translate every post through the fake Azure endpoint (default 0)
+    topics       number of hashtags to monitor through search, each post is tagged with two of them (default 0)
+    search_paging  honour: search applies since_id and max_id; ignore: search always returns the newest page
+                   (default honour)
+    port         port for the fake services (default 8765)
+"""
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process
+from threading import Lock
+from time import perf_counter, sleep, time
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+PAGE_SIZE = 20
+POST_ID_BASE = 113000000000000000
+
+DEFAULTS = {
+    'accounts': 20,
+    'posts': 200,
+    'scenario': 'burst',
+    'duration': 30.0,
+    'poll': 1.0,
+    'timeout': 300.0,
+    'settle': 5,
+    'latency': 0.0,
+    'error_rate': 0.0,
+    'rate_limit': 0,
+    'rate_window': 300.0,
+    'translate': 0,
+    'topics': 0,
+    'search_paging': 'honour',
+    'port': 8765,
+}
+
+
+def build_schedule(accounts: int, posts: int, scenario: str, duration: float, start: float) -> dict:
+    """Assign each post an account and a publish time. Returns {account_index: [(post_id, publish_time), ...]}."""
+    schedule = {i: [] for i in range(accounts)}
+    for n in range(posts):
+        if scenario == 'steady':
+            published = start + duration * n / max(posts, 1)
+        else:
+            published = start
+        schedule[n % accounts].append((POST_ID_BASE + n, published))
+    return schedule
+
+
+class FakeServices:
+    """State shared by the fake endpoints: scheduled posts, injected faults and what Discord received."""
+
+    def __init__(self, config: dict, schedule: dict, base_url: str) -> None:
+        self.config = config
+        self.schedule = schedule
+        self.base_url = base_url
+        self.lock = Lock()
+        self.published = {post_id: published for posts in schedule.values() for post_id, published in posts}
+        self.received = {}
+        self.duplicates = 0
+        self.requests = {}
+        self.window_start = time()
+        self.window_count = 0
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def rate_limit_headers(self) -> tuple[bool, dict]:
+        limit = int(self.config['rate_limit'])
+        if not limit:
+            return True, {}
+        with self.lock:
+            now = time()
+            if now - self.window_start >= self.config['rate_window']:
+                self.window_start, self.window_count = now, 0
+            self.window_count += 1
+            remaining = max(limit - self.window_count, 0)
+            reset = datetime.fromtimestamp(self.window_start + self.config['rate_window'], timezone.utc)
+            allowed = self.window_count <= limit
+        return allowed, {
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': reset.isoformat(),
+        }
+
+    def status(self, account: int, post_id: int, published: float) -> dict:
+        acct = f'loadtest{account}'
+        tags = ''
+        if self.config['topics']:
+            n = post_id - POST_ID_BASE
+            tags = f' #topic{n % self.config["topics"]} #topic{(n + 1) % self.config["topics"]}'
+        return {
+            'id': str(post_id),
+            'created_at': datetime.fromtimestamp(published, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            'url': f'{self.base_url}/@{acct}/posts/{post_id}',
+            'content': f'<p>Load test post {post_id} from {acct}.{tags}</p><p>Second paragraph for the builder.</p>',
+            'account': {'id': str(account), 'acct': acct, 'display_name': f'Load Test {account}'},
+            'media_attachments': [],
+            'reblog': None,
+            'quote': None,
+        }
+
+    def search(self, query: str, limit: int, since_id: int = None, max_id: int = None) -> list:
+        """Statuses containing query, newest first, between since_id and max_id unless paging is ignored."""
+        if self.config['search_paging'] == 'ignore':
+            since_id = max_id = None
+        now = time()
+        matches = []
+        for account, posts in self.schedule.items():
+            for post_id, published in posts:
+                if published > now or (since_id and post_id <= since_id) or (max_id and post_id >= max_id):
+                    continue
+                status = self.status(account, post_id, published)
+                if query in status['content']:
+                    matches.append(status)
+        matches.sort(key=lambda s: int(s['id']), reverse=True)
+        return matches[:limit]
+
+    def statuses(self, account: int, max_id: int = None) -> list:
+        now = time()
+        visible = [(post_id, published) for post_id, published in self.schedule.get(account, [])
+                   if published <= now and (max_id is None or post_id < max_id)]
+        visible.sort(reverse=True)
+        return [self.status(account, post_id, published) for post_id, published in visible[:PAGE_SIZE]]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    services: FakeServices = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/_stats':
+            with self.services.lock:
+                return self._reply(200, {
+                    'published': self.services.published,
+                    'received': self.services.received,
+                    'duplicates': self.services.duplicates,
+                    'requests': self.services.requests,
+                })
+        if not self._inject_faults('truthsocial'):
+            return
+        allowed, headers = self.services.rate_limit_headers()
+        if not allowed:
+            self.services.count('truthsocial_throttled')
+            return self._reply(429, {'error': 'Rate limit exceeded'}, headers)
+        if url.path == '/api/v1/accounts/lookup':
+            acct = query.get('acct', [''])[0]
+            return self._reply(200, {'id': acct.removeprefix('loadtest'), 'acct': acct}, headers)
+        if url.path == '/api/v2/search':
+            since_id = int(query['since_id'][0]) if 'since_id' in query else None
+            max_id = int(query['max_id'][0]) if 'max_id' in query else None
+            statuses = self.services.search(query['q'][0], int(query.get('limit', ['20'])[0]), since_id, max_id)
+            return self._reply(200, {'accounts': [], 'statuses': statuses, 'hashtags': []}, headers)
+        match = re.fullmatch(r'/api/v1/accounts/(\d+)/statuses', url.path)
+        if match:
+            max_id = int(query['max_id'][0]) if 'max_id' in query else None
+            return self._reply(200, self.services.statuses(int(match.group(1)), max_id), headers)
+        self._reply(404, {'error': 'Record not found'})
+
+    def do_HEAD(self):
+        self._reply(404, None)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path == '/oauth/token':
+            self.services.count('oauth')
+            return self._reply(200, {'access_token': 'loadtest-token', 'token_type': 'Bearer'})
+        if url.path.startswith('/api/webhooks/'):
+            if not self._inject_faults('discord'):
+                return
+            received = time()
+            match = re.search(rb'/posts/(\d+)', body)
+            if match:
+                with self.services.lock:
+                    if int(match.group(1)) in self.services.received:
+                        self.services.duplicates += 1
+                    self.services.received.setdefault(int(match.group(1)), received)
+            # discord_webhook waits for the message by default, so reply like Discord does with ?wait=true
+            return self._reply(200, {'id': str(int(received * 1000)), 'attachments': []})
+        if url.path == '/translate':
+            if not self._inject_faults('azure'):
+                return
+            texts = json.loads(body or b'[]')
+            return self._reply(200, [{'translations': [{'text': t['text'], 'to': 'en'}]} for t in texts])
+        self._reply(404, {'error': 'Not found'})
+
+    def _inject_faults(self, endpoint: str) -> bool:
+        self.services.count(endpoint)
+        latency = self.services.config['latency']
+        if latency:
+            sleep(random.expovariate(1 / latency))
+        if random.random() < self.services.config['error_rate']:
+            self.services.count(endpoint + '_failed')
+            self._reply(503, {'error': 'Injected failure'})
+            return False
+        return True
+
+    def _reply(self, code: int, payload, headers: dict = None) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+def serve(config: dict, schedule: dict) -> None:
+    base_url = f'http://127.0.0.1:{config["port"]}'
+    FakeHandler.services = FakeServices(config, schedule, base_url)
+    ThreadingHTTPServer(('127.0.0.1', config['port']), FakeHandler).serve_forever()
+
+
+def fetch_stats(base_url: str) -> dict:
+    with urlopen(base_url + '/_stats') as resp:
+        stats = json.load(resp)
+    stats['published'] = {int(k): v for k, v in stats['published'].items()}
+    stats['received'] = {int(k): v for k, v in stats['received'].items()}
+    return stats
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def configure_environment(config: dict, base_url: str, workdir: str) -> None:
+    """Point TruthCord at the fakes. Must run before any truthcord module is imported."""
+    os.environ.update({
+        'TRUTHSOCIAL_USER': ','.join(f'loadtest{i}' for i in range(config['accounts'])),
+        'TRUTHSOCIAL_TOPICS': ','.join(f'#topic{i}' for i in range(config['topics'])),
+        'TRUTHSOCIAL_BASE_URL': base_url,
+        'TRUTHSOCIAL_USERNAME': 'loadtest',
+        'TRUTHSOCIAL_PASSWORD': 'loadtest',
+        'DISCORD_WEBHOOK_URL': base_url + '/api/webhooks/1/loadtest',
+        'AZURE_TRANSLATOR_ENDPOINT': base_url,
+        'AZURE_TRANSLATOR_KEY': 'loadtest' if config['translate'] else '',
+        'AZURE_TRANSLATOR_LOCATION': 'loadtest' if config['translate'] else '',
+        'TRANSLATE_FROM_LANGUAGE': 'en' if config['translate'] else '',
+        'TRANSLATE_TO_LANGUAGE': 'zh-Hans' if config['translate'] else '',
+        'TRUTHSOCIAL_RATE_LIMIT': str(max(1, round(config['poll']))),
+        'TRUTH_ARCHIVE_PATH': os.path.join(workdir, 'archive.sqlite3'),
+        'TRUTHCORD_LEASE_PATH': '',
+        'RECOMPRESS_IMAGES': 'false',
+        'IMGUR_CLIENT_ID': '',
+        'IMGUR_CLIENT_SECRET': '',
+        'IMGUR_REFRESH_TOKEN': '',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'http_proxy': '',
+        'https_proxy': '',
+    })
+    # Log in through the fake /oauth/token rather than with a real token.
+    os.environ.pop('TRUTHSOCIAL_TOKEN', None)
+
+
+def run(config: dict) -> dict:
+    base_url = f'http://127.0.0.1:{config["port"]}'
+    start = time() + 2
+    schedule = build_schedule(config['accounts'], config['posts'], config['scenario'], config['duration'], start)
+    server = Process(target=serve, args=(config, schedule), daemon=True)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix='truthcord-loadtest-')
+    configure_environment(config, base_url, workdir)
+
+    tracemalloc.start()
+    from truthcord.truthcord import TruthCord
+    bot = TruthCord(pull_since=datetime.fromtimestamp(start - 1, timezone.utc))
+
+    last_published = max(published for posts in schedule.values() for _, published in posts)
+    polls, poll_seconds, idle_polls, delivered, setbacks = 0, [], 0, 0, 0
+    started = perf_counter()
+    try:
+        while perf_counter() - started < config['timeout']:
+            poll_started = perf_counter()
+            bot.check_truth()
+            poll_seconds.append(perf_counter() - poll_started)
+            polls += 1
+            stats = fetch_stats(base_url)
+            received = len(stats['received'])
+            if received >= config['posts']:
+                break
+            # Posts lost to injected Discord failures are never retried, so stop once deliveries settle. A poll
+            # that was throttled or failed on Truth Social may have missed posts the next one picks up, so it
+            # does not count as idle, but it does not reset the count either.
+            requests = stats['requests']
+            polled_setbacks = requests.get('truthsocial_throttled', 0) + requests.get('truthsocial_failed', 0)
+            if received != delivered or time() <= last_published:
+                idle_polls = 0
+            elif polled_setbacks == setbacks:
+                idle_polls += 1
+            if idle_polls >= config['settle']:
+                break
+            delivered, setbacks = received, polled_setbacks
+            sleep(config['poll'])
+        stats = fetch_stats(base_url)
+    finally:
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        server.terminate()
+
+    lags = [received - stats['published'][post_id] for post_id, received in stats['received'].items()]
+    first_published = min(stats['published'].values())
+    last_received = max(stats['received'].values(), default=first_published)
+    elapsed = last_received - first_published
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        peak_rss = float('nan')
+    return {
+        'delivered': len(stats['received']),
+        'published': len(stats['published']),
+        'throughput': len(stats['received']) / elapsed if elapsed > 0 else float('nan'),
+        'lag_p50': percentile(lags, 50),
+        'lag_p90': percentile(lags, 90),
+        'lag_p99': percentile(lags, 99),
+        'lag_max': max(lags, default=float('nan')),
+        'polls': polls,
+        'poll_p50': percentile(poll_seconds, 50),
+        'poll_max': max(poll_seconds, default=float('nan')),
+        'peak_traced_mb': peak_traced / 1024**2,
+        'peak_rss_mb': peak_rss,
+        'duplicates': stats['duplicates'],
+        'requests': stats['requests'],
+    }
+
+
+def report(config: dict, result: dict) -> None:
+    print(f"Scenario: {config['scenario']}, {config['accounts']} accounts, {config['posts']} posts, "
+          f"latency {config['latency']}s, error rate {config['error_rate']:.1%}")
+    print(f"Delivered:   {result['delivered']}/{result['published']} posts over {result['polls']} polls, "
+          f"{result['published'] - result['delivered']} lost, {result['duplicates']} duplicates")
+    print(f"Throughput:  {result['throughput']:.2f} posts/s")
+    print(f"Lag:         p50 {result['lag_p50']:.2f}s, p90 {result['lag_p90']:.2f}s, "
+          f"p99 {result['lag_p99']:.2f}s, max {result['lag_max']:.2f}s")
+    print(f"Poll time:   p50 {result['poll_p50']:.2f}s, max {result['poll_max']:.2f}s")
+    print(f"Peak memory: {result['peak_traced_mb']:.1f}MB traced, {result['peak_rss_mb']:.1f}MB RSS")
+    print(f"Requests:    {', '.join(f'{k} {v}' for k, v in sorted(result['requests'].items()))}")
+
+
+def parse_args(argv: list) -> dict:
+    config = dict(DEFAULTS)
+    for arg in argv:
+        if '=' not in arg:
+            raise ValueError(f"Unexpected argument {arg}, expected key=value.")
+        key, value = arg.split('=', 1)
+        if key not in DEFAULTS:
+            raise ValueError(f"Unknown argument {key}.")
+        config[key] = type(DEFAULTS[key])(value)
+    return config
+
+
+if __name__ == '__main__':
+    config = parse_args(sys.argv[1:])
+    report(config, run(config))
@@ -0,0 +1,95 @@
+import json
+import logging
+import sqlite3
+import zlib
+from threading import Lock
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TruthArchive:
+    """Append-only archive of raw statuses, stored as zlib compressed JSON in SQLite and keyed by account and id.
+
+    It also keeps the newest status id seen per search query, so searches resume where they left off after a restart.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS statuses ("
+            "account TEXT NOT NULL, "
+            "id INTEGER NOT NULL, "
+            "data BLOB NOT NULL, "
+            "PRIMARY KEY (account, id)"
+            ") WITHOUT ROWID"
+        )
+        # Replaying every account reads in id order, which the primary key cannot serve.
+        self._conn.execute("CREATE INDEX IF NOT EXISTS statuses_id ON statuses (id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cursors (key TEXT PRIMARY KEY, id INTEGER NOT NULL)")
+        self._conn.commit()
+        logger.debug("Archive opened at %s.", path)
+
+    def add(self, statuses: list[tuple[str, dict]]) -> int:
+        """Archive (account, raw status) pairs in a single commit. Returns how many were not archived already."""
+        rows = [
+            (account, int(status['id']), zlib.compress(json.dumps(status, separators=(',', ':')).encode('utf-8')))
+            for account, status in statuses
+        ]
+        with self._lock:
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO statuses (account, id, data) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+        return cursor.rowcount
+
+    def iter_statuses(self, account: str = None, since_id: int = None) -> Iterator[dict]:
+        """Yield archived statuses in chronological order, optionally for a single account and newer than since_id."""
+        query = "SELECT data FROM statuses"
+        clauses, params = [], []
+        if account:
+            clauses.append("account = ?")
+            params.append(account)
+        if since_id:
+            clauses.append("id > ?")
+            params.append(int(since_id))
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY id"
+        cursor = self._conn.cursor()
+        with self._lock:
+            cursor.execute(query, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                break
+            for (data,) in rows:
+                yield json.loads(zlib.decompress(data))
+
+    def get_cursor(self, key: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM cursors WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, key: str, status_id: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO cursors (key, id) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET id = excluded.id",
+                (key, status_id))
+            self._conn.commit()
+
+    def count(self, account: str = None) -> int:
+        with self._lock:
+            if account:
+                row = self._conn.execute(
+                    "SELECT COUNT(*) FROM statuses WHERE account = ?", (account,)).fetchone()
+            else:
+                row = self._conn.execute("SELECT COUNT(*) FROM statuses").fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
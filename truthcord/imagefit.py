@@ -0,0 +1,130 @@
+import io
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+SCALES = (1.0, 0.8, 0.6, 0.45, 0.33, 0.25)
+MIN_QUALITY = 40
+MAX_QUALITY = 92
+FILE_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def _encode(image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _best_quality(image, image_format: str, limit: int) -> Optional[bytes]:
+    """Binary search the highest quality that encodes under limit bytes."""
+    low, high, best = MIN_QUALITY, MAX_QUALITY, None
+    while low <= high:
+        quality = (low + high) // 2
+        data = _encode(image, image_format, quality)
+        if len(data) <= limit:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+
+def _flatten(source, image_format: str):
+    """Convert to a mode the format can encode. JPEG has no alpha, so transparency is composited onto white."""
+    if image_format == 'WEBP':
+        return source.convert('RGBA')
+    if source.mode in ('RGBA', 'LA', 'PA') or (source.mode == 'P' and 'transparency' in source.info):
+        rgba = source.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return source.convert('RGB')
+
+
+def fit_image(data: bytes, limit: int, image_format: str = 'JPEG') -> tuple[Optional[bytes], float]:
+    """Downscale and recompress an image until it fits under limit bytes.
+
+    Returns the new image, or None if it could not be made to fit, and the seconds spent.
+    Animated images are left alone since re-encoding them would drop the animation.
+    """
+    started = perf_counter()
+    result = None
+    with Image.open(io.BytesIO(data)) as source:
+        if getattr(source, 'n_frames', 1) == 1:
+            image = _flatten(source, image_format)
+            for scale in SCALES:
+                if scale < 1.0:
+                    size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+                    candidate = image.resize(size, Image.LANCZOS)
+                else:
+                    candidate = image
+                result = _best_quality(candidate, image_format, limit)
+                if result:
+                    break
+    return result, perf_counter() - started
+
+
+class ImageRecompressor:
+    """Runs fit_image in a process pool so several oversized images are recompressed in parallel, and keeps stats."""
+
+    def __init__(self, limit: int, workers: int = 2, image_format: str = 'JPEG') -> None:
+        if Image is None:
+            raise ValueError("Pillow is not installed.")
+        image_format = image_format.upper()
+        if image_format not in FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported image format {image_format}.")
+        self.limit = limit
+        self.image_format = image_format
+        self.extension = FILE_EXTENSIONS[image_format]
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._lock = Lock()
+        self.stats = {
+            'attempted': 0,
+            'fitted': 0,
+            'seconds': 0.0,
+            'bytes_saved': 0,
+            'imgur_avoided': 0
+        }
+
+    def submit(self, data: bytes) -> Future:
+        return self._pool.submit(fit_image, data, self.limit, self.image_format)
+
+    def collect(self, original_size: int, future: Future, imgur_enabled: bool) -> Optional[bytes]:
+        """Wait for a submitted image and record the outcome. Returns the recompressed image if it fits."""
+        try:
+            data, seconds = future.result()
+        except Exception as e:
+            logger.error("Error recompressing image: %s", e, exc_info=True)
+            data, seconds = None, 0.0
+        with self._lock:
+            self.stats['attempted'] += 1
+            self.stats['seconds'] += seconds
+            if data:
+                self.stats['fitted'] += 1
+                self.stats['bytes_saved'] += original_size - len(data)
+                if imgur_enabled:
+                    self.stats['imgur_avoided'] += 1
+        if data:
+            logger.info("Image recompressed from %.2fMB to %.2fMB in %.2fs.",
+                        original_size/1024/1024, len(data)/1024/1024, seconds)
+        else:
+            logger.info("Image could not be recompressed under the limit in %.2fs.", seconds)
+        return data
+
+    def log_stats(self) -> None:
+        stats = self.stats
+        logger.info("Recompression: %s/%s images fitted, %.2fMB saved, %.2fs spent, %s Imgur uploads avoided.",
+                    stats['fitted'], stats['attempted'], stats['bytes_saved']/1024/1024,
+                    stats['seconds'], stats['imgur_avoided'])
+
+    def close(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
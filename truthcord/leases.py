@@ -0,0 +1,183 @@
+import logging
+import math
+import os
+import socket
+import sqlite3
+from time import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# How long sent post ids are remembered for deduplicating posts across topics and accounts, in seconds.
+DELIVERED_RETENTION = 7 * 24 * 3600
+
+
+class LeaseStore:
+    """Shares monitored accounts between TruthCord workers through leases in a SQLite file.
+
+    Each worker heartbeats on every poll and takes an even share of the accounts. Leases of dead workers
+    expire after ttl seconds and are picked up by the survivors. The store also keeps the id of the last
+    post delivered per account, and a claim per post: a worker claims a post before sending it and confirms
+    it once Discord accepted it, which moves the cursor. A failed send releases the claim so it can be retried.
+    Workers keep their unsent claims fresh while heartbeating, and a claim left behind by a dead worker can
+    be taken over after ttl seconds.
+    """
+
+    def __init__(self, path: str, ttl: float, worker_id: str = None) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "account TEXT PRIMARY KEY, "
+            "owner TEXT, "
+            "expires REAL NOT NULL DEFAULT 0, "
+            "cursor INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS claims ("
+            "post_id INTEGER PRIMARY KEY, "
+            "owner TEXT NOT NULL, "
+            "at REAL NOT NULL, "
+            "sent INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Unsent claims under our id were left by a previous run that did not get to release them.
+        self._conn.execute("DELETE FROM claims WHERE owner = ? AND sent = 0", (self.worker_id,))
+
+    def rebalance(self, accounts: list[str]) -> list[str]:
+        """Heartbeat, renew our leases, and claim or release accounts to hold a fair share. Returns the accounts we own."""
+        now = time()
+        with self._transaction():
+            self._conn.execute(
+                "INSERT INTO workers (worker, heartbeat) VALUES (?, ?) "
+                "ON CONFLICT(worker) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.worker_id, now))
+            self._conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.ttl,))
+            live_workers = self._conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+            share = math.ceil(len(accounts) / max(live_workers, 1))
+
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO leases (account) VALUES (?)", [(a,) for a in accounts])
+            owned = self._accounts_where("owner = ? AND expires > ?", (self.worker_id, now), accounts)
+            if len(owned) > share:
+                released = owned[share:]
+                owned = owned[:share]
+                self._conn.executemany(
+                    "UPDATE leases SET owner = NULL, expires = 0 WHERE account = ? AND owner = ?",
+                    [(a, self.worker_id) for a in released])
+                logger.info("Released %s to other workers.", ', '.join(released))
+            elif len(owned) < share:
+                free = self._accounts_where("owner IS NULL OR expires <= ?", (now,), accounts)
+                claimed = free[:share - len(owned)]
+                owned += claimed
+                if claimed:
+                    logger.info("Claimed %s.", ', '.join(claimed))
+            self._conn.executemany(
+                "UPDATE leases SET owner = ?, expires = ? WHERE account = ?",
+                [(self.worker_id, now + self.ttl, a) for a in owned])
+            self._conn.execute("DELETE FROM claims WHERE sent = 1 AND at < ?", (now - DELIVERED_RETENTION,))
+            self._touch_claims(now)
+        return owned
+
+    def renew(self) -> None:
+        """Heartbeat and extend the leases we still hold, without rebalancing. For long polls between rebalances."""
+        now = time()
+        with self._transaction():
+            self._conn.execute(
+                "INSERT INTO workers (worker, heartbeat) VALUES (?, ?) "
+                "ON CONFLICT(worker) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.worker_id, now))
+            self._conn.execute(
+                "UPDATE leases SET expires = ? WHERE owner = ? AND expires > ?",
+                (now + self.ttl, self.worker_id, now))
+            self._touch_claims(now)
+
+    def get_cursor(self, account: str) -> Optional[int]:
+        row = self._conn.execute("SELECT cursor FROM leases WHERE account = ?", (account,)).fetchone()
+        return row[0] if row else None
+
+    def holds(self, account: str) -> bool:
+        """Whether we still hold an unexpired lease on account."""
+        row = self._conn.execute(
+            "SELECT 1 FROM leases WHERE account = ? AND owner = ? AND expires > ?",
+            (account, self.worker_id, time())).fetchone()
+        return row is not None
+
+    def advance_cursor(self, account: str, post_id: int) -> bool:
+        """Move the account's cursor to post_id. Returns False if we no longer hold the lease or it is already past it."""
+        cursor = self._conn.execute(
+            "UPDATE leases SET cursor = ? "
+            "WHERE account = ? AND owner = ? AND expires > ? AND (cursor IS NULL OR cursor < ?)",
+            (post_id, account, self.worker_id, time(), post_id))
+        return cursor.rowcount > 0
+
+    def claim_post(self, post_id: int) -> bool:
+        """Claim a post for sending across all workers and keys.
+
+        Returns False if it was already sent or is claimed by a live worker, including this one.
+        To retry a post after a failed send, release it first.
+        """
+        now = time()
+        cursor = self._conn.execute(
+            "INSERT INTO claims (post_id, owner, at) VALUES (?, ?, ?) "
+            "ON CONFLICT(post_id) DO UPDATE SET owner = excluded.owner, at = excluded.at "
+            "WHERE claims.sent = 0 AND claims.at < ?",
+            (post_id, self.worker_id, now, now - self.ttl))
+        return cursor.rowcount > 0
+
+    def is_sent(self, post_id: int) -> bool:
+        row = self._conn.execute("SELECT sent FROM claims WHERE post_id = ?", (post_id,)).fetchone()
+        return bool(row and row[0])
+
+    def confirm_post(self, account: str, post_id: int) -> None:
+        """Mark a claimed post as sent and move the account's cursor past it."""
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE claims SET sent = 1, at = ? WHERE post_id = ?", (time(), post_id))
+            self._conn.execute(
+                "UPDATE leases SET cursor = ? WHERE account = ? AND owner = ? AND (cursor IS NULL OR cursor < ?)",
+                (post_id, account, self.worker_id, post_id))
+
+    def release_post(self, post_id: int) -> None:
+        """Give up our claim on a post that failed to send, so it can be retried."""
+        self._conn.execute(
+            "DELETE FROM claims WHERE post_id = ? AND owner = ? AND sent = 0", (post_id, self.worker_id))
+
+    def release_all(self) -> None:
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE leases SET owner = NULL, expires = 0 WHERE owner = ?", (self.worker_id,))
+            self._conn.execute("DELETE FROM workers WHERE worker = ?", (self.worker_id,))
+            self._conn.execute("DELETE FROM claims WHERE owner = ? AND sent = 0", (self.worker_id,))
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _accounts_where(self, condition: str, params: tuple, accounts: list[str]) -> list[str]:
+        rows = self._conn.execute(f"SELECT account FROM leases WHERE {condition}", params).fetchall()
+        matched = {row[0] for row in rows}
+        return [a for a in accounts if a in matched]
+
+    def _touch_claims(self, now: float) -> None:
+        # Posts can wait a while for their images, keep their claims from looking abandoned meanwhile.
+        self._conn.execute("UPDATE claims SET at = ? WHERE owner = ? AND sent = 0", (now, self.worker_id))
+
+    def _transaction(self):
+        return _ImmediateTransaction(self._conn)
+
+
+class _ImmediateTransaction:
+    """Takes the SQLite write lock up front so concurrent workers rebalance one at a time."""
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+
+def parse_created_at(created_at: str) -> datetime:
+    """Parse a status timestamp into a timezone aware datetime, assuming UTC if no offset is given."""
+    date_time = datetime.fromisoformat(created_at)
+    if date_time.tzinfo is None:
+        date_time = date_time.replace(tzinfo=timezone.utc)
+    return date_time
+
+
+@dataclass(frozen=True, slots=True)
+class Attachment:
+    type: str
+    url: str
+
+    @classmethod
+    def from_dict(cls, attachment: dict) -> 'Attachment':
+        return cls(type=attachment['type'], url=attachment['url'])
+
+
+@dataclass(frozen=True, slots=True)
+class Post:
+    """The parts of a Truth Social status that TruthCord uses, parsed once when the status is pulled."""
+    id: int
+    created_at: datetime
+    url: str
+    content: str
+    display_name: str
+    media_attachments: tuple[Attachment, ...] = ()
+    reblog: Optional['Post'] = None
+    quote: Optional['Post'] = None
+
+    @classmethod
+    def from_status(cls, status: dict) -> 'Post':
+        return cls(
+            id=int(status['id']),
+            created_at=parse_created_at(status['created_at']),
+            url=status.get('url') or '',
+            content=status.get('content') or '',
+            display_name=(status.get('account') or {}).get('display_name', ''),
+            media_attachments=tuple(
+                Attachment.from_dict(a) for a in status.get('media_attachments') or ()),
+            reblog=cls.from_status(status['reblog']) if status.get('reblog') else None,
+            quote=cls.from_status(status['quote']) if status.get('quote') else None
+        )
+
+    @property
+    def all_attachments(self) -> tuple[Attachment, ...]:
+        """Attachments of the post followed by those of the reblogged and quoted posts."""
+        attachments = self.media_attachments
+        if self.reblog:
+            attachments += self.reblog.media_attachments
+        if self.quote:
+            attachments += self.quote.media_attachments
+        return attachments
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+from time import perf_counter
+from dotenv import load_dotenv
+
+from .archive import TruthArchive
+from .models import Post
+from .truthbuilder import TruthBuilder
+from .utils import setup_logging
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+TRUTH_ARCHIVE_PATH = os.getenv('TRUTH_ARCHIVE_PATH', 'truth_archive.sqlite3')
+
+logger = logging.getLogger(__name__)
+
+
+class LocalDiscordSink:
+    """Stands in for a Discord webhook. Writes each message to a JSON lines file, or just counts it if no path is given."""
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self.sent = 0
+        self._file = open(path, 'w', encoding='utf-8') if path else None
+
+    def send(self, username: str, content: str, files: list) -> None:
+        self.sent += 1
+        if not self._file:
+            return
+        message = {
+            'username': username,
+            'content': content,
+            'files': [{'filename': f['filename'], 'size': len(f['file'])} for f in files]
+        }
+        self._file.write(json.dumps(message, ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+
+
+def replay(archive: TruthArchive, builder: TruthBuilder, sink: LocalDiscordSink,
+           account: str = None, since_id: int = None, limit: int = None) -> dict:
+    """Stream archived statuses through the builder into the sink as fast as possible."""
+    built, failed = 0, 0
+    started = perf_counter()
+    for status in archive.iter_statuses(account, since_id):
+        if limit and built + failed >= limit:
+            break
+        try:
+            post = Post.from_status(status)
+            content, files = builder.build_truth(post)
+            sink.send(post.display_name, content, files)
+            built += 1
+        except Exception as e:
+            logger.error("Error rebuilding truth %s: %s", status.get('id'), e, exc_info=True,
+                         extra={'post_id': status.get('id'), 'stage': 'replay'})
+            failed += 1
+    elapsed = perf_counter() - started
+    return {
+        'built': built,
+        'failed': failed,
+        'seconds': elapsed,
+        'per_second': built / elapsed if elapsed else 0.0
+    }
+
+
+def run_replay(archive: str = TRUTH_ARCHIVE_PATH, account: str = None, since_id: str = None,
+               limit: str = None, out: str = None, online: str = None) -> None:
+    setup_logging(LOG_LEVEL)
+    if not os.path.exists(archive):
+        raise FileNotFoundError(f"Archive {archive} not found.")
+    truth_archive = TruthArchive(archive)
+    builder = TruthBuilder(offline=(online or '').lower() not in ('1', 'true', 'yes'))
+    sink = LocalDiscordSink(out)
+    logger.info("Replaying %s archived posts from %s.", truth_archive.count(account), archive)
+    try:
+        stats = replay(truth_archive, builder, sink, account,
+                       int(since_id) if since_id else None, int(limit) if limit else None)
+    finally:
+        sink.close()
+        builder.close()
+        truth_archive.close()
+    logger.info("Replayed %s posts (%s failed) in %.2fs, %.1f posts/s.",
+                stats['built'], stats['failed'], stats['seconds'], stats['per_second'])
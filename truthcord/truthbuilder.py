@@ -1,10 +1,12 @@
 import logging
+from dataclasses import dataclass, field
 import requests
 from dotenv import load_dotenv
 import os
 from bs4 import BeautifulSoup
 from quickimgurpy import ImgurClient
-from datetime import datetime
+from .imagefit import ImageRecompressor
+from .models import Attachment, Post
 from .utils import azure_translate
 
 logger = logging.getLogger(__name__)
@@ -15,6 +17,10 @@ DISCORD_FILE_LIMIT = int(os.getenv('DISCORD_FILE_LIMIT', 10*1024**2)) - 1
 DISCORD_CHARACTER_LIMIT = int(os.getenv('DISCORD_CHARACTER_LIMIT', 2000)) - 200
 TRANSLATE_FROM_LANGUAGE = os.getenv('TRANSLATE_FROM_LANGUAGE')
 TRANSLATE_TO_LANGUAGE = os.getenv('TRANSLATE_TO_LANGUAGE')
+RECOMPRESS_IMAGES = os.getenv('RECOMPRESS_IMAGES', 'false').lower() in ('1', 'true', 'yes')
+RECOMPRESS_FORMAT = os.getenv('RECOMPRESS_FORMAT', 'JPEG')
+RECOMPRESS_WORKERS = int(os.getenv('RECOMPRESS_WORKERS', 2))
+RECOMPRESS_MAX_SOURCE_SIZE = int(os.getenv('RECOMPRESS_MAX_SOURCE_SIZE', 50*1024**2))
 
 WORD_LIMIT_MARKER = ' ...\n-# :small_orange_diamond: Word limit'
 WORD_LIMIT_MARKER_LENGTH = len(WORD_LIMIT_MARKER)
@@ -51,6 +57,13 @@ def trim_text_by_length(text: str, length: int) -> str:
     return text[:length - WORD_LIMIT_MARKER_LENGTH].rstrip() + WORD_LIMIT_MARKER
 
 
+def get_attachment_markup(attachment: Attachment):
+    if attachment.type == 'video':
+        return f':small_blue_diamond: [Click here to watch the video]({attachment.url})'
+    else:
+        return f':small_blue_diamond: [Click here to view the image]({attachment.url})'
+
+
 def parse_html(html_content):
     soup = BeautifulSoup(html_content, 'html.parser')
     external_links = []
@@ -76,14 +89,14 @@ def parse_html(html_content):
             if 'h-card' in span.get('class', []):
                 if header_card:
                     logger.warning(
-                        f"Multiple header cards found in {html_content} Skipping...")
+                        "Multiple header cards found in %s Skipping...", html_content)
                 else:
                     header_card = span.get_text()
                 span.replace_with("")
             elif 'quote-inline' in span.get('class', []):
                 if quote_in_line:
                     logger.warning(
-                        f"Multiple quote in lines found in {html_content}. Skipping...")
+                        "Multiple quote in lines found in %s. Skipping...", html_content)
                 else:
                     url = span.get_text()
                     url = url[url.find('http'):]
@@ -104,7 +117,7 @@ def parse_html(html_content):
                     "â€œ", "“").replace("â€", "”").replace("â€™", "'").replace("â€¦", "...")
                 paragraph_texts.append(p_text)
 
-    logger.debug(f"Parsed HTML. Found {len(paragraph_texts)} paragraphs, {len(external_links)} external links, {quote_in_line} quote in line, {header_card} header card.")
+    logger.debug("Parsed HTML. Found %s paragraphs, %s external links, %s quote in line, %s header card.", len(paragraph_texts), len(external_links), quote_in_line, header_card)
     return {
         'paragraph_texts': paragraph_texts,
         'quote_in_line': quote_in_line,
@@ -113,25 +126,60 @@ def parse_html(html_content):
     }
 
 
+@dataclass(slots=True)
+class TruthBuild:
+    """A truth whose attachments are downloaded, with oversized images possibly still being recompressed."""
+    truth: Post
+    files: list
+    inline_links: list
+    # (attachment, filename, file_data, future) for each image handed to the recompressor.
+    recompressing: list = field(default_factory=list)
+
+    @property
+    def ready(self) -> bool:
+        return all(future.done() for *_, future in self.recompressing)
+
+
 class TruthBuilder:
-    def __init__(self):
-        try:
-            self.imgur = ImgurClient()
-        except ValueError as e:
-            logger.debug(f"Imgur client not initialised: {e}")
-            self.imgur = None
-        self.translation_enabled = TRANSLATE_FROM_LANGUAGE and TRANSLATE_TO_LANGUAGE
-
-    def build_truth(self, truth: dict):
-        logger.debug(f"Building truth content.")
-        files, inline_links = self._convert_attachments(truth)
-        content = self._build_truth_content(truth, inline_links)
-        return content, files
-
-    def _build_truth_content(self, truth: dict, inline_links: list) -> str:
-        date_time = datetime.fromisoformat(truth['created_at'])
-        top_line = f'-# :loudspeaker: [@realDonaldTrump]({truth["url"]}) • <t:{int(date_time.timestamp())}>\n'
-        main_contents = parse_html(truth['content'])
+    def __init__(self, offline: bool = False):
+        # Offline mode renders without touching the network: no translation, and attachments become links.
+        self.offline = offline
+        self.imgur = None
+        self.recompressor = None
+        if not offline:
+            try:
+                self.imgur = ImgurClient()
+            except ValueError as e:
+                logger.debug("Imgur client not initialised: %s", e)
+            if RECOMPRESS_IMAGES:
+                try:
+                    self.recompressor = ImageRecompressor(DISCORD_FILE_LIMIT, RECOMPRESS_WORKERS, RECOMPRESS_FORMAT)
+                except ValueError as e:
+                    logger.warning("Image recompression not enabled: %s", e)
+        self.translation_enabled = bool(TRANSLATE_FROM_LANGUAGE and TRANSLATE_TO_LANGUAGE) and not offline
+
+    def build_truth(self, truth: Post):
+        return self.finish_truth(self.start_truth(truth))
+
+    def start_truth(self, truth: Post) -> TruthBuild:
+        """Download the attachments and hand oversized images to the recompressor without waiting for it."""
+        logger.debug("Building truth content.", extra={'post_id': truth.id, 'stage': 'build'})
+        files, inline_links, recompressing = self._convert_attachments(truth)
+        return TruthBuild(truth, files, inline_links, recompressing)
+
+    def finish_truth(self, build: TruthBuild):
+        """Collect the recompressed images, waiting for them if they are not ready, and build the content."""
+        self._collect_recompressed(build)
+        content = self._build_truth_content(build.truth, build.inline_links)
+        return content, build.files
+
+    def close(self) -> None:
+        if self.recompressor:
+            self.recompressor.close()
+
+    def _build_truth_content(self, truth: Post, inline_links: list) -> str:
+        top_line = f'-# :loudspeaker: [@realDonaldTrump]({truth.url}) • <t:{int(truth.created_at.timestamp())}>\n'
+        main_contents = parse_html(truth.content)
         inline_links += main_contents['external_links']
         inline_links = build_line(' ｜ '.join(inline_links), '> -# ', line_break=False)
 
@@ -144,36 +192,38 @@ class TruthBuilder:
             footer_text_en = 'Quoted from ' + main_contents['quote_in_line']
 
         reblog_texts, quoted_texts = [], []
-        if truth['reblog']:
-            reblog_texts = parse_html(truth['reblog']['content'])[
+        if truth.reblog:
+            reblog_texts = parse_html(truth.reblog.content)[
                 'paragraph_texts']
-        if truth['quote']:
-            quoted_texts = parse_html(truth['quote']['content'])[
+        if truth.quote:
+            quoted_texts = parse_html(truth.quote.content)[
                 'paragraph_texts']
 
         attached_texts = '\n\n'.join(reblog_texts) or '\n\n'.join(quoted_texts)
 
         # No real contents
         if not main_contents['paragraph_texts'] and not reblog_texts and not quoted_texts:
-            logger.debug(f"No real contents found.")
+            logger.debug("No real contents found.")
             return top_line + (header_text or footer_text) + inline_links
 
+        joined_main_text = '\n\n'.join(main_contents['paragraph_texts'])
+        translation, error_text = None, ''
         if self.translation_enabled:
-            joined_main_text = '\n\n'.join(main_contents['paragraph_texts'])
             texts_to_translate = [{'text': joined_main_text},
                                 {'text': '\n\n'.join(reblog_texts)},
                                 {'text': '\n\n'.join(quoted_texts)}]
 
-            logger.debug(f"Translating content.")
+            logger.debug("Translating content.", extra={'post_id': truth.id, 'stage': 'translate'})
             try:
                 translation = azure_translate(texts_to_translate)
             except Exception as e:
-                logger.error(f"Error translating content: {e}", exc_info=True)
+                logger.error("Error translating content: %s", e, exc_info=True,
+                             extra={'post_id': truth.id, 'stage': 'translate'})
                 translation = None
             error_text = translation.get('error', '') if translation else ''
         # Not translating or translation failed, return original text
         if translation is None or error_text:
-            logger.debug(f"Translation failed. Showing original text.")
+            logger.debug("Translation failed. Showing original text.")
             if self.translation_enabled:
                 translation_failed_text = '\n-# :small_orange_diamond:Translation failed' + build_line(error_text, ': ', single_line_break=True)
             else:
@@ -202,58 +252,57 @@ class TruthBuilder:
             build_line("\n\n".join(reblog_texts), "> -# ", line_break=False) +
             build_line("\n\n".join(quoted_texts), "> -# ", line_break=False)
         ).rstrip()
-        logger.debug(f"Content built.")
+        logger.debug("Content built.")
         return trim_text_by_length(content, DISCORD_CHARACTER_LIMIT - len(inline_links) - 200) + inline_links
 
-    def _convert_attachments(self, truth: dict):
-        if not truth['media_attachments'] and not (
-            truth['reblog'] and truth['reblog']['media_attachments']) and not (
-            truth['quote'] and truth['quote']['media_attachments']
-        ):
-            logger.debug(f"No attachments found.")
-            return [], []
-
-        def get_attachment_markup(attachment: dict):
-            if attachment['type'] == 'video':
-                return f':small_blue_diamond: [Click here to watch the video]({attachment["url"]})'
-            else:
-                return f':small_blue_diamond: [Click here to view the image]({attachment["url"]})'
+    def _convert_attachments(self, truth: Post):
+        media_attachments = truth.all_attachments
+        if not media_attachments:
+            logger.debug("No attachments found.")
+            return [], [], []
 
         discord_attachments = []
         inline_links = []
-        media_attachments = truth['media_attachments']
-        if truth['reblog']:
-            media_attachments += truth['reblog']['media_attachments']
-        if truth['quote']:
-            media_attachments += truth['quote']['media_attachments']
+        # Oversized images handed to the recompressor, collected by finish_truth.
+        recompressing = []
+
+        if self.offline:
+            return [], [get_attachment_markup(attachment) for attachment in media_attachments], []
 
         for attachment in media_attachments:
-            logger.debug(f"Processing attachment.")
+            logger.debug("Processing attachment.", extra={'post_id': truth.id, 'stage': 'attachment'})
             try:
-                file_url = attachment['url']
-                filename = attachment['url'].split('/')[-1]
+                file_url = attachment.url
+                filename = attachment.url.split('/')[-1]
                 
                 head_response = requests.head(file_url)
                 content_length = int(head_response.headers.get('Content-Length', 0))
                 
+                recompressible = self.recompressor is not None and attachment.type == 'image'
+
                 # If file is larger than 15MB, skip download
-                if (self.imgur and content_length > 15 * 1024 * 1024) or (
-                    self.imgur is None and content_length > DISCORD_FILE_LIMIT
-                ):
+                if recompressible:
+                    too_large = content_length > RECOMPRESS_MAX_SOURCE_SIZE
+                else:
+                    too_large = (self.imgur and content_length > 15 * 1024 * 1024) or (
+                        self.imgur is None and content_length > DISCORD_FILE_LIMIT)
+                if too_large:
                     inline_links.append(get_attachment_markup(attachment))
-                    logger.debug(f"Attachment too large, skipped. File size: {content_length/1024/1024:.2f}MB")
+                    logger.debug("Attachment too large, skipped. File size: %.2fMB", content_length/1024/1024)
                     continue
 
                 response = requests.get(file_url)
                 response.raise_for_status()
                 file_data = response.content
-                logger.info(f"Attachment downloaded. File size: {len(file_data)/1024/1024:.2f}MB")
+                logger.info("Attachment downloaded. File size: %.2fMB", len(file_data)/1024/1024)
 
                 imgur_url = None
-                if self.imgur and len(file_data) > DISCORD_FILE_LIMIT:
-                    if attachment['type'] in ['image', 'video']:
+                if recompressible and len(file_data) > DISCORD_FILE_LIMIT:
+                    recompressing.append((attachment, filename, file_data, self.recompressor.submit(file_data)))
+                elif self.imgur and len(file_data) > DISCORD_FILE_LIMIT:
+                    if attachment.type in ['image', 'video']:
                         imgur_url = self._upload_to_imgur(
-                            file_data, attachment['type'])
+                            file_data, attachment.type)
                     inline_links.append(
                         imgur_url or get_attachment_markup(attachment))
                 else:
@@ -264,10 +313,26 @@ class TruthBuilder:
 
             except Exception as e:
                 logger.error(
-                    f"Failed to handle attachment {file_url}: {str(e)}", exc_info=True)
+                    "Failed to handle attachment %s: %s", file_url, e, exc_info=True,
+                    extra={'post_id': truth.id, 'stage': 'attachment'})
                 inline_links.append(get_attachment_markup(attachment))
 
-        return discord_attachments, inline_links
+        return discord_attachments, inline_links, recompressing
+
+    def _collect_recompressed(self, build: TruthBuild) -> None:
+        for attachment, filename, file_data, future in build.recompressing:
+            fitted = self.recompressor.collect(len(file_data), future, self.imgur is not None)
+            if fitted:
+                build.files.append({
+                    'filename': filename.rsplit('.', 1)[0] + '.' + self.recompressor.extension,
+                    'file': fitted
+                })
+                continue
+            imgur_url = self._upload_to_imgur(file_data, attachment.type) if self.imgur else None
+            build.inline_links.append(imgur_url or get_attachment_markup(attachment))
+        if build.recompressing:
+            self.recompressor.log_stats()
+        build.recompressing = []
 
     def _upload_to_imgur(self, file_data: bytes, file_type: str):
         try:
@@ -278,6 +343,6 @@ class TruthBuilder:
             if resp['truth'] == 200:
                 return resp['data']['link']
         except Exception as e:
-            logger.error(f"Error uploading to imgur: {e}", exc_info=True)
+            logger.error("Error uploading to imgur: %s", e, exc_info=True)
 
         return None
\ No newline at end of file
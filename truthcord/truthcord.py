@@ -1,87 +1,294 @@
+from collections import OrderedDict
 from datetime import datetime, timezone
 import logging
 import os
-from time import sleep
+from time import monotonic, sleep, time
 from discord_webhook import DiscordWebhook
 from dotenv import load_dotenv
 
-from .truthsocial import TruthSocial
-from .truthbuilder import TruthBuilder
+from .archive import TruthArchive
+from .leases import LeaseStore
+from .models import Post
+from .truthsocial import SEARCH_KEY_PREFIX, TruthSocial
+from .truthbuilder import TruthBuild, TruthBuilder
 from .utils import setup_logging
 
 load_dotenv()
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 TRUTH_USER = os.getenv('TRUTHSOCIAL_USER')
+TRUTH_TOPICS = os.getenv('TRUTHSOCIAL_TOPICS')
 DISCORD_WEBHOOK_URL = os.getenv('DISCORD_WEBHOOK_URL')
 TRUTHSOCIAL_RATE_LIMIT = int(os.getenv('TRUTHSOCIAL_RATE_LIMIT', 60))
+TRUTH_ARCHIVE_PATH = os.getenv('TRUTH_ARCHIVE_PATH', 'truth_archive.sqlite3')
+TRUTHCORD_LEASE_PATH = os.getenv('TRUTHCORD_LEASE_PATH')
+TRUTHCORD_LEASE_TTL = float(os.getenv('TRUTHCORD_LEASE_TTL', 3 * TRUTHSOCIAL_RATE_LIMIT))
+TRUTHCORD_WORKER_ID = os.getenv('TRUTHCORD_WORKER_ID')
+# Number of recently sent post ids remembered to deduplicate posts matching several topics or accounts.
+DEDUPE_SIZE = 10000
+# Polls a post is retried on before it is skipped, when sharing accounts through leases.
+MAX_SEND_ATTEMPTS = 3
+# Seconds between checks on recompressing images while waiting for the next poll.
+PENDING_CHECK_INTERVAL = 0.5
 
 
 setup_logging(LOG_LEVEL)
 
 logger = logging.getLogger(__name__)
 
-if not TRUTH_USER or not DISCORD_WEBHOOK_URL:
-    raise ValueError('TRUTH_USER and DISCORD_WEBHOOK_URL must be set in .env')
+if not (TRUTH_USER or TRUTH_TOPICS) or not DISCORD_WEBHOOK_URL:
+    raise ValueError('TRUTH_USER or TRUTH_TOPICS, and DISCORD_WEBHOOK_URL must be set in .env')
 
 
 class TruthCord():
     def __init__(self, pull_since: datetime = datetime.now(timezone.utc)) -> None:
         logger.info("TruthCord initializing...")
-        self.truth_user: str = TRUTH_USER
+        self.truth_users: list[str] = [u.strip() for u in (TRUTH_USER or '').split(',') if u.strip()]
+        self.topics: list[str] = [t.strip() for t in (TRUTH_TOPICS or '').split(',') if t.strip()]
         self.discord_webhook_url: str = DISCORD_WEBHOOK_URL
         self.rate_limit: int = TRUTHSOCIAL_RATE_LIMIT
-        self.last_pull: datetime = pull_since
-        self.truth_social = TruthSocial()
+        self.pull_since: datetime = pull_since
+        self.last_pulls: dict[str, datetime] = {user: pull_since for user in self.truth_users}
+        self.archive = TruthArchive(TRUTH_ARCHIVE_PATH) if TRUTH_ARCHIVE_PATH else None
+        self.leases = LeaseStore(
+            TRUTHCORD_LEASE_PATH, TRUTHCORD_LEASE_TTL, TRUTHCORD_WORKER_ID) if TRUTHCORD_LEASE_PATH else None
+        self.truth_social = TruthSocial(archive=self.archive)
         self.truth_builder = TruthBuilder()
+        self.search_cursors: dict[str, int] = {}
+        if self.archive:
+            for topic in self.topics:
+                self.search_cursors[topic] = self.archive.get_cursor(SEARCH_KEY_PREFIX + topic)
+        self.recent_post_ids: OrderedDict[int, None] = OrderedDict()
+        self.send_attempts: dict[int, int] = {}
+        # Posts waiting on image recompression per key: the posts left to send, oldest last, and the oldest one's build.
+        self.pending: dict[str, tuple[list, TruthBuild]] = {}
+        self.owned_keys: list[str] = []
+        self.owned_until: float = 0
         logger.info("TruthCord initialized.")
-        logger.info(f"Set to monitor posts from {self.truth_user} published since {self.last_pull}.")
-        
+        if self.truth_users:
+            logger.info("Set to monitor posts from %s published since %s.", ', '.join(self.truth_users), self.pull_since)
+        if self.topics:
+            logger.info("Set to monitor posts matching %s.", ', '.join(self.topics))
+        if self.leases:
+            logger.info("Sharing accounts with other workers through %s as %s.", TRUTHCORD_LEASE_PATH, self.leases.worker_id)
+
     def run(self) -> None:
         logger.info("TruthCord running...")
-        while True:
-            self.check_truth()
-            sleep(self.rate_limit)
+        try:
+            while True:
+                self.check_truth()
+                self._wait(self.rate_limit)
+        finally:
+            if self.leases:
+                self.leases.release_all()
+            self.truth_builder.close()
 
     def check_truth(self) -> None:
-        posts = self._fetch_new_posts()
-        self._process_posts(posts)
+        self._resume_pending()
+        for key in self._owned_keys():
+            if key in self.pending:
+                # Its images are still recompressing, fetching again would only find the same posts.
+                continue
+            self._renew_leases()
+            if key.startswith(SEARCH_KEY_PREFIX):
+                self._check_topic(key[len(SEARCH_KEY_PREFIX):])
+                continue
+            posts = self._fetch_new_posts(key)
+            self._process_posts(key, posts)
+
+    def _wait(self, seconds: float) -> None:
+        """Sleep until the next poll, sending posts as soon as their images are recompressed."""
+        deadline = monotonic() + seconds
+        while (remaining := deadline - monotonic()) > 0:
+            sleep(min(remaining, PENDING_CHECK_INTERVAL) if self.pending else remaining)
+            self._resume_pending()
 
-    def _fetch_new_posts(self) -> list:
+    def _resume_pending(self) -> None:
+        for key, (posts, build) in list(self.pending.items()):
+            if build.ready:
+                del self.pending[key]
+                self._process_posts(key, posts, build)
+
+    def _owned_keys(self) -> list[str]:
+        """Accounts and search topics this process should poll. Topics are prefixed with SEARCH_KEY_PREFIX."""
+        keys = self.truth_users + [SEARCH_KEY_PREFIX + topic for topic in self.topics]
+        if not self.leases:
+            return keys
+        renewed_at = time()
+        try:
+            self.owned_keys = self.leases.rebalance(keys)
+            self.owned_until = renewed_at + self.leases.ttl
+        except Exception as e:
+            if time() < self.owned_until:
+                # Our leases have not expired yet, so keep polling them. Each send still checks the lease.
+                logger.warning("Error renewing leases, keeping %s until they expire: %s", ', '.join(self.owned_keys), e)
+                return self.owned_keys
+            logger.error("Error renewing leases: %s", e, exc_info=True)
+            self.owned_keys = []
+        return self.owned_keys
+
+    def _renew_leases(self) -> None:
+        """Extend our leases once half their ttl has passed, so a long poll does not let them expire midway."""
+        if not self.leases or time() < self.owned_until - self.leases.ttl / 2:
+            return
+        renewed_at = time()
+        try:
+            self.leases.renew()
+            self.owned_until = renewed_at + self.leases.ttl
+        except Exception as e:
+            logger.warning("Error renewing leases: %s", e)
+
+    def _fetch_new_posts(self, account: str) -> list:
         posts = []
+        if self.leases:
+            # Resume from the last post any worker delivered for this account.
+            since_id = self.leases.get_cursor(account)
+            created_after = None if since_id else self.pull_since
+        else:
+            since_id, created_after = None, self.last_pulls[account]
         try:
-            for post in self.truth_social.pull_statuses(self.truth_user, created_after=self.last_pull):
+            for post in self.truth_social.pull_statuses(account, created_after=created_after, since_id=since_id):
                 posts.append(post)
         except Exception as e:
-            logger.error(f"Error fetching new posts: {e}", exc_info=True)
+            logger.error("Error fetching new posts: %s", e, exc_info=True)
         return posts
 
-    def _process_posts(self, posts: list) -> None:
-        success = 0
-        for post in posts[::-1]:
-            if self._process_single_post(post):
+    def _check_topic(self, topic: str) -> None:
+        key = SEARCH_KEY_PREFIX + topic
+        if self.leases:
+            # Resume from the last match any worker handled, like accounts.
+            since_id = self.leases.get_cursor(key)
+            created_after = None if since_id else self.pull_since
+        else:
+            # Like accounts, only send matches published since pull_since. The saved cursor just saves downloading
+            # results again after a restart.
+            since_id, created_after = self.search_cursors.get(topic), self.pull_since
+        try:
+            posts, newest_id = self.truth_social.search_statuses(topic, since_id=since_id, created_after=created_after)
+        except Exception as e:
+            logger.error("Error searching for %s: %s", topic, e, exc_info=True)
+            return
+        done = self._process_posts(key, posts)
+        # Move the cursor past results that were filtered out too, so they are not downloaded again.
+        if done and newest_id and newest_id != since_id:
+            if self.leases:
+                self.leases.advance_cursor(key, newest_id)
+            else:
+                self.search_cursors[topic] = newest_id
+                if self.archive:
+                    self.archive.set_cursor(key, newest_id)
+
+    def _process_posts(self, account: str, posts: list, build: TruthBuild = None) -> bool:
+        """Send posts oldest first. Returns False if some were left for later.
+
+        If a post's images are still being recompressed, it and the newer posts are parked in self.pending
+        and sent once the images are ready, so the other accounts keep being polled meanwhile. build is the
+        already claimed and started oldest post when resuming.
+        """
+        success, done = 0, True
+        for n in range(len(posts) - 1, -1, -1):
+            post = posts[n]
+            self._renew_leases()
+            if self.leases and not self.leases.holds(account):
+                logger.warning("Lease on %s lost, leaving post %s and newer to its owner.", account, post.id,
+                               extra={'post_id': post.id, 'stage': 'lease'})
+                if build:
+                    self.leases.release_post(post.id)
+                done = False
+                break
+            if build is None:
+                if any(parked.truth.id == post.id for _, parked in self.pending.values()):
+                    # Already claimed for another key and waiting for its images, look again on the next poll.
+                    done = False
+                    break
+                if not self._claim_post(post.id):
+                    if self.leases and not self.leases.is_sent(post.id):
+                        # Another worker is sending it right now, look again on the next poll.
+                        done = False
+                        break
+                    logger.debug("Post %s from %s already sent for another topic or account.", post.id, account,
+                                 extra={'post_id': post.id, 'stage': 'dedupe'})
+                    if self.leases:
+                        self.leases.advance_cursor(account, post.id)
+                    continue
+                build = self.truth_builder.start_truth(post)
+                if not build.ready:
+                    logger.debug("Post %s from %s waiting for image recompression.", post.id, account,
+                                 extra={'post_id': post.id, 'stage': 'attachment'})
+                    self.pending[account] = (posts[:n + 1], build)
+                    done = False
+                    break
+            sent = self._process_single_post(account, post, build)
+            build = None
+            if sent:
+                self._confirm_post(account, post.id)
                 success += 1
-        logger.info(f"Found {len(posts)} new posts, sent {success} to Discord.")
+            elif not self._skip_failed_post(account, post):
+                done = False
+                break
+        logger.info("Found %s new posts from %s, sent %s to Discord.", len(posts), account, success)
+        return done
+
+    def _claim_post(self, post_id: int) -> bool:
+        """Returns False if the post was already sent because it matched another topic or account."""
+        if self.leases:
+            return self.leases.claim_post(post_id)
+        if post_id in self.recent_post_ids:
+            return False
+        self.recent_post_ids[post_id] = None
+        if len(self.recent_post_ids) > DEDUPE_SIZE:
+            self.recent_post_ids.popitem(last=False)
+        return True
+
+    def _confirm_post(self, account: str, post_id: int) -> None:
+        self.send_attempts.pop(post_id, None)
+        if self.leases:
+            self.leases.confirm_post(account, post_id)
+
+    def _skip_failed_post(self, account: str, post: Post) -> bool:
+        """Decide what to do with a post that failed to build or send. Returns False if it should be retried.
+
+        When sharing accounts through leases, the claim is released and the post retried on the next poll,
+        up to MAX_SEND_ATTEMPTS. Otherwise it is skipped, as the cursor is the time of the last pull.
+        """
+        if not self.leases:
+            return True
+        attempts = self.send_attempts.get(post.id, 0) + 1
+        if attempts < MAX_SEND_ATTEMPTS:
+            self.send_attempts[post.id] = attempts
+            self.leases.release_post(post.id)
+            logger.warning("Post %s from %s failed to send, retrying on the next poll.", post.id, account,
+                           extra={'post_id': post.id, 'stage': 'send'})
+            return False
+        logger.error("Post %s from %s failed to send %s times, skipping it.", post.id, account, attempts,
+                     extra={'post_id': post.id, 'stage': 'send'})
+        self._confirm_post(account, post.id)
+        return True
 
-    def _process_single_post(self, post: dict) -> bool:
+    def _process_single_post(self, account: str, post: Post, build: TruthBuild) -> bool:
         try:
-            content, files = self.truth_builder.build_truth(post)
-            self.last_pull = datetime.now(timezone.utc)
+            content, files = self.truth_builder.finish_truth(build)
+            # Resume from the post itself rather than the clock, so posts published while this one was being
+            # built, or parked for its images, are still fetched next time.
+            self.last_pulls[account] = max(self.last_pulls.get(account, post.created_at), post.created_at)
             self._send_to_discord(post, content, files)
             return True
         except Exception as e:
-            logger.error(f"Error building truth for {self.truth_user}: {e}", exc_info=True)
+            logger.error("Error building truth for %s: %s", account, e, exc_info=True,
+                         extra={'post_id': post.id, 'stage': 'build'})
             return False
 
-    def _send_to_discord(self, post: dict, content: str, files: list) -> None:
+    def _send_to_discord(self, post: Post, content: str, files: list) -> None:
         webhook = self._create_webhook(post, content, files)
-        webhook.execute()
-        logger.info(f"New post sent.")
+        response = webhook.execute()
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f"Discord returned {response.status_code}.")
+        logger.info("New post sent.", extra={'post_id': post.id, 'stage': 'send'})
 
-    def _create_webhook(self, post: dict, content: str, files: list) -> DiscordWebhook:
+    def _create_webhook(self, post: Post, content: str, files: list) -> DiscordWebhook:
         webhook = DiscordWebhook(
             url=self.discord_webhook_url,
-            username=post['account']['display_name'],
+            username=post.display_name,
             content=content
         )
         for file in files:
@@ -1,7 +1,6 @@
 # Credit to truthbrush: https://github.com/stanfordio/truthbrush
 from typing import Any, Iterator, Optional
-from dateutil import parser as date_parse
-from datetime import datetime, timezone
+from datetime import datetime
 from curl_cffi import requests
 import curl_cffi
 import json
@@ -9,12 +8,14 @@ import logging
 import os
 from dotenv import load_dotenv
 
+from .models import Post
+
 load_dotenv() 
 
 logger = logging.getLogger(__name__)
 
-BASE_URL = "https://truthsocial.com"
-API_BASE_URL = "https://truthsocial.com/api"
+BASE_URL = os.getenv("TRUTHSOCIAL_BASE_URL", "https://truthsocial.com").rstrip("/")
+API_BASE_URL = BASE_URL + "/api"
 USER_AGENT = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 "
     "Safari/537.36"
@@ -31,6 +32,11 @@ TRUTHSOCIAL_PASSWORD = os.getenv("TRUTHSOCIAL_PASSWORD")
 
 TRUTHSOCIAL_TOKEN = os.getenv("TRUTHSOCIAL_TOKEN")
 
+# Lease and cursor key prefix for keyword and hashtag searches, to keep them apart from account names.
+SEARCH_KEY_PREFIX = "search:"
+# Most pages fetched by one search, so a server that ignores paging cannot keep us looping.
+MAX_SEARCH_PAGES = 10
+
 
 class LoginErrorException(Exception):
     pass
@@ -42,11 +48,13 @@ class TruthSocial:
         username=TRUTHSOCIAL_USERNAME,
         password=TRUTHSOCIAL_PASSWORD,
         token=TRUTHSOCIAL_TOKEN,
+        archive=None,
     ):
         self.__username = username
         self.__password = password
         self.auth_id = token
         self.user_name_id_map = {}
+        self.archive = archive
 
     def __check_login(self):
         """Runs before any login-walled function to check for login credentials and generates an auth ID token"""
@@ -56,7 +64,7 @@ class TruthSocial:
             if self.__password is None:
                 raise LoginErrorException("Password is missing.")
             self.auth_id = self.get_auth_id(self.__username, self.__password)
-            logger.warning(f"Using token {self.auth_id}")
+            logger.warning("Using token %s", self.auth_id)
 
     def _make_session(self):
         s = requests.Session()
@@ -78,12 +86,12 @@ class TruthSocial:
                 headers=headers,
             )
         except curl_cffi.curl.CurlError as e:
-            logger.error(f"Curl error: {e}")
+            logger.error("Curl error: %s", e)
 
         try:
             r = resp.json()
         except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON: {resp.text}")
+            logger.error("Failed to decode JSON: %s", resp.text)
             r = None
 
         return r
@@ -100,52 +108,81 @@ class TruthSocial:
         searchtype: str = None,
         query: str = None,
         limit: int = 40,
-        resolve: bool = 4,
-        offset: int = 0,
-        min_id: str = "0",
+        resolve: bool = True,
+        since_id: str = None,
         max_id: str = None,
-    ) -> Optional[dict]:
-        """Search users, statuses or hashtags."""
+    ) -> Iterator[dict]:
+        """Search users, statuses or hashtags.
+
+        Status results are paged backwards with max_id, newest first, until a page reaches since_id or
+        comes back short, so passing the newest id already seen only fetches newer results. Paging stops
+        if the server does not move past max_id, and after MAX_SEARCH_PAGES pages.
+        Other types return a single page.
+        """
 
         self.__check_login()
         assert query is not None and searchtype is not None
 
-        page = 0
-        while page < limit:
-            if max_id is None:
-                resp = self._get(
-                    "/v2/search",
-                    params=dict(
-                        q=query,
-                        resolve=resolve,
-                        limit=limit,
-                        type=searchtype,
-                        offset=offset,
-                        min_id=min_id,
-                    ),
-                )
+        for _ in range(MAX_SEARCH_PAGES):
+            params = dict(q=query, resolve=str(bool(resolve)).lower(), limit=limit, type=searchtype)
+            if since_id:
+                params["since_id"] = since_id
+            if max_id:
+                params["max_id"] = max_id
+            resp = self._get("/v2/search", params=params)
 
-            else:
-                resp = self._get(
-                    "/v2/search",
-                    params=dict(
-                        q=query,
-                        resolve=resolve,
-                        limit=limit,
-                        type=searchtype,
-                        offset=offset,
-                        min_id=min_id,
-                        max_id=max_id,
-                    ),
-                )
-
-            offset += 40
-            # added new not sure if helpful
-            if not resp or all(value == [] for value in resp.values()):
-                break
+            if not resp or "error" in resp or all(value == [] for value in resp.values()):
+                return
 
             yield resp
 
+            statuses = resp.get("statuses") or []
+            if searchtype != "statuses" or len(statuses) < limit:
+                return
+            oldest_id = min(int(s["id"]) for s in statuses)
+            if since_id and oldest_id <= int(since_id):
+                return
+            if max_id and oldest_id >= int(max_id):
+                logger.warning("Search for %s did not page past %s, stopping.", query, max_id)
+                return
+            max_id = str(oldest_id)
+        logger.warning("Search for %s stopped after %s pages, older results were skipped.", query, MAX_SEARCH_PAGES)
+
+    def search_statuses(
+        self,
+        query: str,
+        since_id: int = None,
+        created_after: datetime = None,
+    ) -> tuple[list[Post], Optional[int]]:
+        """Fetch statuses matching query that are newer than since_id.
+
+        Pages are fetched back to since_id or created_after, whichever is reached first. With neither, only the
+        most recent page is fetched.
+        Returns the matching posts in reverse chronological order and the newest status id seen,
+        which is the cursor to pass as since_id next time. Matches are archived under their author.
+        """
+        posts = {}
+        newest_id = since_id
+        for page in self.search("statuses", query, since_id=str(since_id) if since_id else None):
+            reached_created_after = False
+            matched = []
+            for status in page.get("statuses") or []:
+                post = Post.from_status(status)
+                newest_id = max(newest_id or 0, post.id)
+                if created_after and post.created_at <= created_after:
+                    reached_created_after = True
+                    continue
+                if since_id and post.id <= since_id:
+                    continue
+                if post.id in posts:
+                    continue
+                posts[post.id] = post
+                matched.append(((status.get("account") or {}).get("acct", ""), status))
+            self._archive(matched)
+            if reached_created_after or not (since_id or created_after):
+                break
+        return sorted(posts.values(), key=lambda p: p.id, reverse=True), newest_id
+
     def pull_statuses(
         self,
         username: str=None,
@@ -154,15 +191,14 @@ class TruthSocial:
         created_after: datetime = None,
         since_id=None,
         pinned=False
-    ) -> Iterator[dict]:
+    ) -> Iterator[Post]:
         """Pull the given user's statuses.
 
         Params:
             created_after : timezone aware datetime object
             since_id : number or string
 
-        Returns a list of posts in reverse chronological order,
-            or an empty list if not found.
+        Yields posts in reverse chronological order. The raw statuses are archived if an archive is set.
         """
 
         params = {}
@@ -181,19 +217,19 @@ class TruthSocial:
                     url += "?exclude_replies=true"
                 if verbose:
                     logger.debug("--------------------------")
-                    logger.debug(f"{url} {params}")
+                    logger.debug("%s %s", url, params)
                 result = self._get(url, params=params)
                 page_counter += 1
             except json.JSONDecodeError as e:
-                logger.error(f"Unable to pull user #{user_id}'s statuses': {e}")
+                logger.error("Unable to pull user #%s's statuses': %s", user_id, e)
                 break
             except Exception as e:
-                logger.error(f"Misc. error while pulling statuses for {user_id}: {e}")
+                logger.error("Misc. error while pulling statuses for %s: %s", user_id, e)
                 break
 
             if "error" in result:
                 logger.error(
-                    f"API returned an error while pulling user #{user_id}'s statuses: {result}"
+                    "API returned an error while pulling user #%s's statuses: %s", user_id, result
                 )
                 break
 
@@ -201,41 +237,55 @@ class TruthSocial:
                 break
 
             if not isinstance(result, list):
-                logger.error(f"Result is not a list (it's a {type(result)}): {result}")
+                logger.error("Result is not a list (it's a %s): %s", type(result), result)
 
             posts = sorted(
-                result, key=lambda k: k["id"], reverse=True
+                result, key=lambda k: int(k["id"]), reverse=True
             )  # reverse chronological order (recent first, older last)
             params["max_id"] = posts[-1][
                 "id"
             ]  # when pulling the next page, get posts before this (the oldest)
 
             if verbose:
-                logger.debug(f"PAGE: {page_counter}")
+                logger.debug("PAGE: %s", page_counter)
 
             if pinned:  # assume single page
                 keep_going = False
 
-            for post in posts:
-                post["_pulled"] = datetime.now().isoformat()
+            page = []
+            for status in posts:
+                post = Post.from_status(status)
 
                 # only keep posts created after the specified date
                 # exclude posts created before the specified date
                 # since the page is listed in reverse chronology, we don't need any remaining posts on this page either
-                post_at = date_parse.parse(post["created_at"]).replace(
-                    tzinfo=timezone.utc
-                )
-                if (created_after and post_at <= created_after) or (
-                    since_id and post["id"] <= since_id
+                if (created_after and post.created_at <= created_after) or (
+                    since_id and post.id <= int(since_id)
                 ):
                     keep_going = False  # stop the loop, request no more pages
                     break  # do not yeild this post or remaining (older) posts on this page
 
                 if verbose:
-                    logger.debug(f"{post['id']} {post['created_at']}")
+                    logger.debug("%s %s", post.id, post.created_at)
+
+                page.append((post, status))
 
+            # Archive the page in one commit before handing out its posts.
+            self._archive([(username, status) for _, status in page])
+            for post, _ in page:
                 yield post
 
+    def _archive(self, statuses: list[tuple[str, dict]]) -> None:
+        if not self.archive or not statuses:
+            return
+        pulled = datetime.now().isoformat()
+        for _, status in statuses:
+            status["_pulled"] = pulled
+        try:
+            self.archive.add(statuses)
+        except Exception as e:
+            logger.error("Failed to archive %s statuses: %s", len(statuses), e, extra={'stage': 'archive'})
+
     def get_auth_id(self, username: str, password: str) -> str:
         """Logs in to Truth account and returns the session token"""
         url = BASE_URL + "/oauth/token"
@@ -262,7 +312,7 @@ class TruthSocial:
             )
             sess_req.raise_for_status()
         except requests.RequestsError as e:
-            logger.error(f"Failed login request: {str(e)}")
+            logger.error("Failed login request: %s", e)
             raise SystemExit('Cannot authenticate to .')
 
         if not sess_req.json()["access_token"]:
@@ -1,8 +1,15 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
 import dotenv
 import requests
 import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
 
 ASHLEY_ID = 1313007325224898580
 ANGELA_ID = 1313008328229785640
@@ -12,8 +19,12 @@ dotenv.load_dotenv()
 
 AZURE_TRANSLATOR_KEY = os.getenv('AZURE_TRANSLATOR_KEY')
 AZURE_TRANSLATOR_LOCATION = os.getenv('AZURE_TRANSLATOR_LOCATION')
+AZURE_TRANSLATOR_ENDPOINT = os.getenv('AZURE_TRANSLATOR_ENDPOINT', 'https://api.cognitive.microsofttranslator.com').rstrip('/')
 TRANSLATE_FROM_LANGUAGE = os.getenv('TRANSLATE_FROM_LANGUAGE')
 TRANSLATE_TO_LANGUAGE = os.getenv('TRANSLATE_TO_LANGUAGE')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'colour')
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', 60))
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 5))
 
 class _ColourFormatter(logging.Formatter):
 
@@ -58,7 +69,74 @@ class _ColourFormatter(logging.Formatter):
         record.exc_text = None
         return output
 
-def setup_logging(level: str) -> None:
+class _JsonFormatter(logging.Formatter):
+
+    # Optional fields callers attach with extra={...}, e.g. extra={'post_id': post.id, 'stage': 'build'}
+    EXTRA_FIELDS = ('post_id', 'stage', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _SamplingFilter(logging.Filter):
+    """Lets through at most `burst` records per call site and message every `window` seconds.
+
+    Only applies to warnings and above. The number of dropped records is attached to the next record
+    let through as `suppressed`.
+    """
+
+    def __init__(self, window: float, burst: int) -> None:
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._seen = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.lineno, record.msg)
+        with self._lock:
+            state = self._seen.get(key)
+            if state is None or record.created - state[0] >= self.window:
+                if state and state[2]:
+                    record.suppressed = state[2]
+                self._seen[key] = [record.created, 1, 0]
+                return True
+            if state[1] < self.burst:
+                state[1] += 1
+                return True
+            state[2] += 1
+            return False
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queues records with the message already built, leaving traceback formatting to the listener thread.
+
+    The message has to be built here because the arguments may be changed by the caller before the listener
+    gets to them. Records below the logger level never reach this point, so formatting is still lazy.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: str, log_format: str = LOG_FORMAT) -> None:
     level_map = {
         'DEBUG': logging.DEBUG,
         'INFO': logging.INFO,
@@ -69,21 +147,33 @@ def setup_logging(level: str) -> None:
     level = level_map.get(level.upper(), logging.INFO)
 
     handler = logging.StreamHandler()
-    formatter = _ColourFormatter()
     
     library, _, _ = __name__.partition('.')
     logger = logging.getLogger(library)
-
-    handler.setFormatter(formatter)
     logger.setLevel(level)
-    logger.addHandler(handler)
+
+    if log_format.lower() != 'json':
+        handler.setFormatter(_ColourFormatter())
+        logger.addHandler(handler)
+        return
+
+    # JSON lines are written by a background thread so logging never blocks the polling loop.
+    handler.setFormatter(_JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(_SamplingFilter(LOG_SAMPLE_WINDOW, LOG_SAMPLE_BURST))
+    logger.addHandler(queue_handler)
 
 def azure_translate(payload: list[dict[str, str]], from_language: str=TRANSLATE_FROM_LANGUAGE, to_language: str=TRANSLATE_TO_LANGUAGE) -> dict[str, str]:
     if not AZURE_TRANSLATOR_KEY or not AZURE_TRANSLATOR_LOCATION:
         return {
             'error': 'Azure Translator API details missing.'
         }
-    api_url = 'https://api.cognitive.microsofttranslator.com/translate'
+    api_url = AZURE_TRANSLATOR_ENDPOINT + '/translate'
 
     params = {
         'api-version': '3.0',